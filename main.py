@@ -1,15 +1,44 @@
+import base64
+import json
 import os
-from typing import List, Optional, Any, Dict
+import re
+import time
+from typing import List, Optional, Any, Dict, Tuple
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerifyMismatchError
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from bson import ObjectId
-from datetime import datetime
+from bson.errors import InvalidId
+from datetime import datetime, timezone
 
-from database import db, create_document, get_documents
+from database import db, create_document, get_documents, close_client
 from schemas import User, Product, Category, Review, CartItem, Order
 
-app = FastAPI(title="E-Commerce API")
+def _orjson_default(obj: Any) -> str:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NAIVE_UTC)
+
+class APIResponse(ORJSONResponse):
+    """ORJSONResponse that also knows how to encode stray ObjectIds.
+
+    Note: when a route returns a plain dict/list, FastAPI still runs
+    jsonable_encoder over it before render() is called. Handlers on hot
+    paths return APIResponse(...) directly to skip that Python-level walk
+    and let orjson do the whole encode in C.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+app = FastAPI(title="E-Commerce API", default_response_class=APIResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,44 +49,112 @@ app.add_middleware(
 )
 
 # Helpers
-class PyObjectId(ObjectId):
-    @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+def encode_cursor(sort_value: Any, last_id: str) -> str:
+    raw = json.dumps(
+        [sort_value, last_id],
+        default=lambda o: o.isoformat() if isinstance(o, datetime) else str(o),
+    ).encode()
+    return base64.urlsafe_b64encode(raw).decode()
 
-    @classmethod
-    def validate(cls, v):
-        if isinstance(v, ObjectId):
-            return v
-        if not ObjectId.is_valid(v):
-            raise ValueError("Invalid objectid")
-        return ObjectId(v)
+def decode_cursor(after: str, key: str) -> Tuple[Any, ObjectId]:
+    try:
+        sort_value, last_id = json.loads(base64.urlsafe_b64decode(after.encode()))
+        last_id = ObjectId(last_id)
+        if key == "created_at" and isinstance(sort_value, str):
+            sort_value = datetime.fromisoformat(sort_value)
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return sort_value, last_id
 
 def serialize_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
     if not doc:
         return doc
     doc["id"] = str(doc.pop("_id")) if doc.get("_id") else None
-    # Convert datetime to isoformat
-    for k, v in list(doc.items()):
-        if isinstance(v, datetime):
-            doc[k] = v.isoformat()
+    # Stringify ObjectId refs (e.g. product_id): routes that return plain
+    # dicts go through FastAPI's jsonable_encoder, which cannot encode them.
+    # Datetimes are left alone; both orjson and jsonable_encoder handle those.
+    for k, v in doc.items():
+        if isinstance(v, ObjectId):
+            doc[k] = str(v)
     return doc
 
+# Case-insensitive collation for the prefix-search fallback index.
+SEARCH_COLLATION = {"locale": "en", "strength": 2}
+
+# Flipped at startup once the text index exists; search falls back to an
+# anchored prefix regex (still an index seek, via the collated title index)
+# when it does not.
+_text_search_ready = False
+
+def search_clause(q: str) -> Dict[str, Any]:
+    if _text_search_ready:
+        return {"$text": {"$search": q}}
+    return {"title": {"$regex": f"^{re.escape(q)}", "$options": "i"}}
+
+def _price_clause(params: Dict[str, Any]) -> Dict[str, Any]:
+    pr = {}
+    if params["min_price"] is not None:
+        pr["$gte"] = params["min_price"]
+    if params["max_price"] is not None:
+        pr["$lte"] = params["max_price"]
+    return {"price": pr} if pr else {}
+
+# Each builder maps the request params to its clause; all clauses stay
+# top-level so they AND together and the search clause drives the plan.
+PRODUCT_FILTER_BUILDERS = (
+    lambda params: search_clause(params["q"]) if params["q"] else {},
+    lambda params: {"category": params["category"]} if params["category"] else {},
+    _price_clause,
+)
+
+def build_product_filter(**params: Any) -> Dict[str, Any]:
+    filt: Dict[str, Any] = {}
+    for build in PRODUCT_FILTER_BUILDERS:
+        filt.update(build(params))
+    return filt
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create the indexes the query paths rely on (no-ops once they exist)."""
+    global _text_search_ready
+    if db is None:
+        return
+    try:
+        await db["product"].create_index([("title", "text"), ("description", "text")])
+        _text_search_ready = True
+    except Exception:
+        _text_search_ready = False
+    await db["product"].create_index("title", collation=SEARCH_COLLATION)
+    await db["product"].create_index("category")
+    await db["product"].create_index("price")
+    # Supports the default keyset pagination sort in /products.
+    await db["product"].create_index([("created_at", -1), ("_id", -1)])
+    await db["cartitem"].create_index("client_id")
+    await db["review"].create_index("product_id")
+    await db["order"].create_index([("client_id", 1), ("created_at", -1)])
+    await db["user"].create_index("email", unique=True)
+
+@app.on_event("shutdown")
+async def close_db():
+    close_client()
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "E-Commerce Backend Ready"}
 
+SCHEMA_INFO = {
+    "collections": [
+        "user", "category", "product", "review", "cartitem", "order"
+    ]
+}
+
 @app.get("/schema")
-def get_schema():
+async def get_schema():
     """Expose basic schema info for the database viewer."""
-    return {
-        "collections": [
-            "user", "category", "product", "review", "cartitem", "order"
-        ]
-    }
+    return SCHEMA_INFO
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -70,26 +167,28 @@ def test_database():
         if db is not None:
             response["database"] = "✅ Connected & Working"
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()[:10]
+            response["collections"] = (await db.list_collection_names())[:10]
         else:
             response["database"] = "⚠️  Available but not initialized"
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:80]}"
     return response
 
-# Auth (basic demo: not secure, no tokens)
+# Auth (basic demo: no tokens)
+password_hasher = PasswordHasher()
+
 class RegisterIn(BaseModel):
     name: str
     email: str
     password: str
 
 @app.post("/auth/register")
-def register(payload: RegisterIn):
-    existing = db["user"].find_one({"email": payload.email}) if db else None
+async def register(payload: RegisterIn):
+    existing = await db["user"].find_one({"email": payload.email}) if db is not None else None
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
-    user = User(name=payload.name, email=payload.email, password_hash=payload.password)
-    user_id = create_document("user", user)
+    user = User(name=payload.name, email=payload.email, password_hash=password_hasher.hash(payload.password))
+    user_id = await create_document("user", user)
     return {"id": user_id, "name": user.name, "email": user.email, "role": user.role}
 
 class LoginIn(BaseModel):
@@ -97,162 +196,281 @@ class LoginIn(BaseModel):
     password: str
 
 @app.post("/auth/login")
-def login(payload: LoginIn):
+async def login(payload: LoginIn):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    user = db["user"].find_one({"email": payload.email, "password_hash": payload.password})
+    # Look up by email alone (unique index seek) and verify the hash in-app.
+    user = await db["user"].find_one({"email": payload.email})
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    try:
+        password_hasher.verify(user.get("password_hash", ""), payload.password)
+    except (VerifyMismatchError, InvalidHash):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
     user = serialize_doc(user)
     return {"id": user["id"], "name": user.get("name"), "email": user.get("email"), "role": user.get("role", "user")}
 
-# Categories
+# Categories: seeded set of a few docs fetched on every page load, so serve
+# them from a short in-process TTL cache instead of a Mongo round trip.
+CATEGORY_CACHE_TTL = 60.0
+_category_cache: Optional[Tuple[float, List[Dict[str, Any]]]] = None
+
 @app.get("/categories")
-def list_categories():
-    items = [serialize_doc(x) for x in db["category"].find()] if db else []
-    return items
+async def list_categories():
+    global _category_cache
+    if db is None:
+        return []
+    now = time.monotonic()
+    if _category_cache is not None and now < _category_cache[0]:
+        return APIResponse(_category_cache[1])
+    items = [serialize_doc(x) async for x in db["category"].find()]
+    _category_cache = (now + CATEGORY_CACHE_TTL, items)
+    return APIResponse(items)
 
 @app.post("/categories")
-def create_category(cat: Category):
-    cat_id = create_document("category", cat)
+async def create_category(cat: Category):
+    global _category_cache
+    cat_id = await create_document("category", cat)
+    _category_cache = None
     return {"id": cat_id}
 
 # Products
 @app.get("/products")
-def list_products(
+async def list_products(
     q: Optional[str] = None,
     category: Optional[str] = None,
     min_price: Optional[float] = Query(None, ge=0),
     max_price: Optional[float] = Query(None, ge=0),
     sort: Optional[str] = Query("-created_at"),
-    page: int = Query(1, ge=1),
+    after: Optional[str] = None,
     limit: int = Query(12, ge=1, le=60),
 ):
     if db is None:
-        return {"items": [], "total": 0, "page": page, "pages": 0}
-    filt: Dict[str, Any] = {}
-    if q:
-        filt["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"description": {"$regex": q, "$options": "i"}},
-        ]
-    if category:
-        filt["category"] = category
-    if min_price is not None or max_price is not None:
-        pr = {}
-        if min_price is not None:
-            pr["$gte"] = min_price
-        if max_price is not None:
-            pr["$lte"] = max_price
-        filt["price"] = pr
-
-    cursor = db["product"].find(filt)
-    if sort:
-        direction = -1 if sort.startswith("-") else 1
-        key = sort[1:] if sort.startswith("-") else sort
-        cursor = cursor.sort(key, direction)
-    total = cursor.count() if hasattr(cursor, 'count') else db["product"].count_documents(filt)
-    cursor = cursor.skip((page - 1) * limit).limit(limit)
-    items = [serialize_doc(x) for x in cursor]
-    return {"items": items, "total": total, "page": page, "pages": (total + limit - 1) // limit}
+        return {"items": [], "has_next": False, "next_cursor": None}
+    filt = build_product_filter(q=q, category=category, min_price=min_price, max_price=max_price)
+
+    sort = sort or "-created_at"
+    direction = -1 if sort.startswith("-") else 1
+    key = sort[1:] if sort.startswith("-") else sort
+
+    # Keyset pagination: seek past the last seen (sort_value, _id) pair
+    # instead of skip(), which walks every skipped entry on each page.
+    if after:
+        last_value, last_id = decode_cursor(after, key)
+        op = "$lt" if direction == -1 else "$gt"
+        filt.setdefault("$and", []).append({"$or": [
+            {key: {op: last_value}},
+            {key: last_value, "_id": {op: last_id}},
+        ]})
+    # Card fields only: skipping description/features and all but the first
+    # image keeps list payloads small on the wire and cheap to decode.
+    projection = {
+        "title": 1, "price": 1, "category": 1, "images": {"$slice": 1},
+        "rating": 1, "rating_count": 1, "in_stock": 1, "created_at": 1,
+    }
+    cursor = db["product"].find(filt, projection)
+    if q and not _text_search_ready:
+        cursor = cursor.collation(SEARCH_COLLATION)
+    cursor = cursor.sort([(key, direction), ("_id", direction)]).limit(limit + 1)
+
+    # Stream straight off the cursor: the page is never materialized in
+    # Python, and the client sees first bytes before the last doc arrives.
+    # The limit+1th doc, if any, only flips has_next and is not emitted.
+    async def gen():
+        yield b'{"items":['
+        count = 0
+        has_next = False
+        last = None
+        async for doc in cursor:
+            if count == limit:
+                has_next = True
+                break
+            doc = serialize_doc(doc)
+            if count:
+                yield b","
+            yield dumps(doc)
+            last = doc
+            count += 1
+        next_cursor = encode_cursor(last.get(key), last["id"]) if has_next and last else None
+        yield b'],"has_next":' + (b"true" if has_next else b"false")
+        yield b',"next_cursor":' + dumps(next_cursor) + b"}"
+
+    return StreamingResponse(gen(), media_type="application/json")
+
+MAX_PRODUCT_COUNT = 10_000
+
+@app.get("/products/count")
+async def count_products(
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+):
+    """Total matching products for admin UIs; capped so the server stops counting early."""
+    if db is None:
+        return {"total": 0, "total_capped": False}
+    filt = build_product_filter(q=q, category=category, min_price=min_price, max_price=max_price)
+    kwargs: Dict[str, Any] = {"limit": MAX_PRODUCT_COUNT}
+    if q and not _text_search_ready:
+        kwargs["collation"] = SEARCH_COLLATION
+    total = await db["product"].count_documents(filt, **kwargs)
+    return {"total": total, "total_capped": total == MAX_PRODUCT_COUNT}
 
 @app.post("/products")
-def create_product(prod: Product):
-    prod_id = create_document("product", prod)
+async def create_product(prod: Product):
+    prod_id = await create_document("product", prod)
     return {"id": prod_id}
 
+SAMPLE_REVIEWS = 3
+
 @app.get("/products/{product_id}")
-def get_product(product_id: str):
+async def get_product(product_id: str, include_reviews: bool = False):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    item = db["product"].find_one({"_id": ObjectId(product_id)})
-    if not item:
+    if not include_reviews:
+        item = await db["product"].find_one({"_id": ObjectId(product_id)})
+        if not item:
+            raise HTTPException(status_code=404, detail="Product not found")
+        return APIResponse(serialize_doc(item))
+    # Join a capped sample of recent reviews; the $limit inside the lookup
+    # sub-pipeline keeps the joined array bounded instead of materializing
+    # every review for the product.
+    pipeline = [
+        {"$match": {"_id": ObjectId(product_id)}},
+        {"$lookup": {
+            "from": "review",
+            "localField": "_id",
+            "foreignField": "product_id",
+            "pipeline": [
+                {"$sort": {"created_at": -1}},
+                {"$limit": SAMPLE_REVIEWS},
+            ],
+            "as": "reviews",
+        }},
+    ]
+    docs = await db["product"].aggregate(pipeline).to_list(length=1)
+    if not docs:
         raise HTTPException(status_code=404, detail="Product not found")
-    return serialize_doc(item)
+    item = docs[0]
+    item["reviews"] = [serialize_doc(r) for r in item.get("reviews", [])]
+    return APIResponse(serialize_doc(item))
 
 # Reviews
 @app.get("/products/{product_id}/reviews")
-def product_reviews(product_id: str):
-    items = [serialize_doc(x) for x in db["review"].find({"product_id": product_id})] if db else []
-    return items
+async def product_reviews(product_id: str):
+    if db is None:
+        return []
+    return APIResponse([serialize_doc(x) async for x in db["review"].find({"product_id": ObjectId(product_id)})])
 
 @app.post("/products/{product_id}/reviews")
-def add_review(product_id: str, rev: Review):
+async def add_review(product_id: str, rev: Review):
     data = rev.model_dump()
-    data["product_id"] = product_id
-    data["created_at"] = datetime.utcnow()
-    _id = db["review"].insert_one(data).inserted_id
+    data["product_id"] = ObjectId(product_id)
+    data["created_at"] = datetime.now(timezone.utc)
+    _id = (await db["review"].insert_one(data)).inserted_id
     return {"id": str(_id)}
 
 # Cart
 @app.get("/cart")
-def get_cart(client_id: str = Query(...)):
+async def get_cart(client_id: str = Query(...), in_stock: Optional[bool] = None):
     if db is None:
         return []
+    # product_id is stored as an ObjectId, so the lookup joins straight onto
+    # product._id; one aggregation replaces a find_one per cart item.
+    # Stage order matters: $match on client_id first so the lookup only joins
+    # this client's handful of rows, and product-side predicates stay inside
+    # the sub-pipeline so they apply before the joined array is built.
+    lookup_pipeline: List[Dict[str, Any]] = []
+    if in_stock is not None:
+        lookup_pipeline.append({"$match": {"in_stock": in_stock}})
+    lookup_pipeline.append({"$project": {"title": 1, "price": 1, "images": {"$slice": ["$images", 1]}, "in_stock": 1}})
+    # Only keep product-less rows (product: null) when no product filter is
+    # active; with in_stock set, dropping them gives the param filter
+    # semantics instead of returning unmatched items as product: null.
+    unwind: Dict[str, Any] = {"path": "$product"}
+    if in_stock is None:
+        unwind["preserveNullAndEmptyArrays"] = True
     pipeline = [
         {"$match": {"client_id": client_id}},
-        {"$lookup": {"from": "product", "localField": "product_id", "foreignField": "_id", "as": "product"}},
-        {"$unwind": "$product"}
+        {"$lookup": {
+            "from": "product",
+            "localField": "product_id",
+            "foreignField": "_id",
+            "pipeline": lookup_pipeline,
+            "as": "product",
+        }},
+        {"$unwind": unwind},
     ]
-    # Because product_id stored as string; ensure lookup works by converting to ObjectId on the fly is complex.
-    # Instead, fetch items then attach product manually.
-    items = list(db["cartitem"].find({"client_id": client_id}))
     result = []
-    for it in items:
-        prod = db["product"].find_one({"_id": ObjectId(it.get("product_id"))}) if it.get("product_id") else None
+    async for it in db["cartitem"].aggregate(pipeline):
+        prod = it.pop("product", None)
         it = serialize_doc(it)
         it["product"] = serialize_doc(prod) if prod else None
         result.append(it)
-    return result
+    return APIResponse(result)
 
 @app.post("/cart")
-def add_to_cart(item: CartItem):
+async def add_to_cart(item: CartItem):
     data = item.model_dump()
-    _id = db["cartitem"].insert_one(data).inserted_id
+    _id = (await db["cartitem"].insert_one(data)).inserted_id
     return {"id": str(_id)}
 
 class CartUpdate(BaseModel):
     qty: int
 
 @app.patch("/cart/{item_id}")
-def update_cart(item_id: str, payload: CartUpdate):
-    res = db["cartitem"].update_one({"_id": ObjectId(item_id)}, {"$set": {"qty": payload.qty, "updated_at": datetime.utcnow()}})
+async def update_cart(item_id: str, payload: CartUpdate):
+    res = await db["cartitem"].update_one({"_id": ObjectId(item_id)}, {"$set": {"qty": payload.qty, "updated_at": datetime.now(timezone.utc)}})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Cart item not found")
     return {"ok": True}
 
 @app.delete("/cart/{item_id}")
-def remove_cart(item_id: str):
-    db["cartitem"].delete_one({"_id": ObjectId(item_id)})
+async def remove_cart(item_id: str):
+    await db["cartitem"].delete_one({"_id": ObjectId(item_id)})
     return {"ok": True}
 
 # Orders
 @app.post("/orders")
-def create_order(order: Order):
+async def create_order(order: Order):
     data = order.model_dump()
-    data["created_at"] = datetime.utcnow()
-    _id = db["order"].insert_one(data).inserted_id
+    data["created_at"] = datetime.now(timezone.utc)
+    _id = (await db["order"].insert_one(data)).inserted_id
     return {"id": str(_id)}
 
 @app.get("/orders")
-def list_orders(client_id: Optional[str] = None):
+async def list_orders(client_id: Optional[str] = None):
+    if db is None:
+        return []
     filt = {"client_id": client_id} if client_id else {}
-    items = [serialize_doc(x) for x in db["order"].find(filt).sort("created_at", -1)] if db else []
-    return items
+    projection = {"items": 1, "status": 1, "subtotal": 1, "shipping": 1, "total": 1, "created_at": 1}
+    cursor = db["order"].find(filt, projection).sort("created_at", -1)
+
+    async def gen():
+        yield b"["
+        first = True
+        async for doc in cursor:
+            if not first:
+                yield b","
+            yield dumps(serialize_doc(doc))
+            first = False
+        yield b"]"
+
+    return StreamingResponse(gen(), media_type="application/json")
 
 # Seed demo data if database empty
 @app.post("/seed")
-def seed_data():
+async def seed_data():
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    if db["product"].count_documents({}) > 0:
+    if await db["product"].count_documents({}) > 0:
         return {"ok": True, "message": "Already seeded"}
     categories = [
         {"name": "Cards", "slug": "cards", "icon": "CreditCard", "description": "Payment cards and fintech"},
         {"name": "Accessories", "slug": "accessories", "icon": "Star", "description": "Premium accessories"},
         {"name": "Software", "slug": "software", "icon": "Settings", "description": "Apps and tools"},
     ]
-    db["category"].insert_many(categories)
+    await db["category"].insert_many(categories, ordered=False)
     products = []
     for i in range(1, 25):
         products.append({
@@ -269,7 +487,7 @@ def seed_data():
             "in_stock": True,
             "features": ["Metal body", "Cashback", "Priority support"]
         })
-    db["product"].insert_many(products)
+    await db["product"].insert_many(products, ordered=False)
     return {"ok": True, "inserted": len(products)}
 
 if __name__ == "__main__":
@@ -11,11 +11,28 @@ Model name is converted to lowercase for the collection name:
 - BlogPost -> "blogs" collection
 """
 
-from pydantic import BaseModel, Field, EmailStr
-from typing import Optional, List, Literal
+from bson import ObjectId
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
+from pydantic import PlainValidator, WithJsonSchema
+from typing import Annotated, Optional, List, Literal
 from datetime import datetime
 
-class User(BaseModel):
+def _validate_object_id(v) -> ObjectId:
+    if isinstance(v, ObjectId):
+        return v
+    if not ObjectId.is_valid(v):
+        raise ValueError("Invalid objectid")
+    return ObjectId(v)
+
+# Accepts an ObjectId or its 24-char hex string; stored as a real ObjectId so
+# lookups can join on _id directly, and rendered as a string at the API edge.
+PyObjectId = Annotated[ObjectId, PlainValidator(_validate_object_id), WithJsonSchema({"type": "string"})]
+
+class SchemaModel(BaseModel):
+    """Shared base: drop unknown payload fields instead of validating them."""
+    model_config = ConfigDict(extra="ignore")
+
+class User(SchemaModel):
     name: str = Field(..., description="Full name")
     email: EmailStr = Field(..., description="Email address")
     password_hash: str = Field(..., description="Hashed password")
@@ -23,13 +40,13 @@ class User(BaseModel):
     is_active: bool = Field(True, description="Whether user is active")
     role: Literal["user", "admin"] = Field("user", description="User role")
 
-class Category(BaseModel):
+class Category(SchemaModel):
     name: str
     slug: str
     icon: Optional[str] = None
     description: Optional[str] = None
 
-class Product(BaseModel):
+class Product(SchemaModel):
     title: str
     description: Optional[str] = None
     price: float = Field(..., ge=0)
@@ -40,19 +57,19 @@ class Product(BaseModel):
     in_stock: bool = True
     features: List[str] = []
 
-class Review(BaseModel):
-    product_id: str
+class Review(SchemaModel):
+    product_id: PyObjectId
     user_name: str
     rating: int = Field(..., ge=1, le=5)
     comment: Optional[str] = None
     created_at: Optional[datetime] = None
 
-class CartItem(BaseModel):
+class CartItem(SchemaModel):
     client_id: str
-    product_id: str
+    product_id: PyObjectId
     qty: int = Field(1, ge=1)
 
-class Order(BaseModel):
+class Order(SchemaModel):
     client_id: str
     items: List[CartItem]
     address: str